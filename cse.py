@@ -14,6 +14,8 @@ from cryptography.hazmat.primitives.ciphers.modes import CBC
 from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.exceptions import InvalidTag
 
+import cse_throttling
+
 AES_BLOCK_SIZE = 128
 AES_BLOCK_SIZE_BYTES = 16
 
@@ -74,16 +76,19 @@ class KMSCryptoContext(CryptoContext):
     :param keyid: Key bytes
     :param kms_client_args: Will be expanded when getting a KMS client
     :param authenticated_encryption: Uses AES-GCM instead of AES-CBC (also allows range gets of files)
+    :param retry_policy: Rate limiting and retry policy for KMS calls, defaults to the process-wide one
     """
 
     def __init__(self, keyid: Optional[str] = None, kms_client_args: Optional[dict] = None,
-                 authenticated_encryption: bool = True):
+                 authenticated_encryption: bool = True,
+                 retry_policy: Optional[cse_throttling.RetryPolicy] = None):
         self.kms_key = keyid
         self.authenticated_encryption = authenticated_encryption
 
         # Store the client instead of creating one every time, performance wins when doing many files
-        self._kms_client = boto3.client("kms")
+        self._kms_client = boto3.client("kms", config=cse_throttling.client_config())
         self._kms_client_args = kms_client_args if kms_client_args else {}
+        self._retry_policy = retry_policy if retry_policy else cse_throttling.default_retry_policy
 
     def enabled(self):
         return self.kms_key is not None
@@ -93,11 +98,12 @@ class KMSCryptoContext(CryptoContext):
             self.kms_key = material_description['kms_cmk_id']
         if self.kms_key is None:
             raise ValueError('KMS Key not provided during initialisation, cannot decrypt data key')
-        kms_response = self._kms_client.decrypt(KeyId=self.kms_key, CiphertextBlob=data_key)
+        kms_response = self._retry_policy.call(self._kms_client, 'decrypt',
+                                               KeyId=self.kms_key, CiphertextBlob=data_key)
         return kms_response['Plaintext']
 
     def get_kms_arn_id(self ):
-        response = self._kms_client.describe_key(KeyId=self.kms_key)
+        response = self._retry_policy.call(self._kms_client, 'describe_key', KeyId=self.kms_key)
         return response['KeyMetadata']['Arn']
 
     def get_encryption_aes_key(self) -> Tuple[bytes, Dict[str, str], str]:
@@ -105,7 +111,8 @@ class KMSCryptoContext(CryptoContext):
             raise ValueError('KMS Key not provided during initialisation, cannot generate data key')
         self.kms_key = self.get_kms_arn_id()
         encryption_context = {'kms_cmk_id': self.kms_key}
-        key_response = self._kms_client.generate_data_key(KeyId=self.kms_key, KeySpec='AES_256')
+        key_response = self._retry_policy.call(self._kms_client, 'generate_data_key',
+                                               KeyId=self.kms_key, KeySpec='AES_256')
         return key_response['Plaintext'], encryption_context, base64.b64encode(key_response['CiphertextBlob']).decode()
 
 
@@ -115,21 +122,26 @@ class S3CSE(object):
     To change S3 region add s3_client_args={'region_name': 'eu-west-1'}
     To use this object, 
     :param crypto_context: Takes a crypto context 
+    :param s3_client: Optional boto3 S3 client, build it with config=cse_throttling.client_config()
+        so that botocore does not retry throttles itself and hide them from the limiter and the counters
     :param s3_client_args: Optional dict of S3 client args
+    :param retry_policy: Rate limiting and retry policy for S3 calls, defaults to the process-wide one
     """
 
-    def __init__(self, crypto_context: CryptoContext, s3_client=None, s3_client_args: Optional[dict] = None):
+    def __init__(self, crypto_context: CryptoContext, s3_client=None, s3_client_args: Optional[dict] = None,
+                 retry_policy: Optional[cse_throttling.RetryPolicy] = None):
         self._backend = default_backend()
         self._crypto_context = crypto_context
         self._session = None
         self._s3_client = s3_client
         self._s3_client_args = s3_client_args if s3_client_args else {}
+        self._retry_policy = retry_policy if retry_policy else cse_throttling.default_retry_policy
 
     def boto3_s3(self):
         return  self._s3_client
 
     def setup(self):
-        self._s3_client = boto3.client("s3")
+        self._s3_client = boto3.client("s3", config=cse_throttling.client_config())
 
     # noinspection PyPep8Naming
     def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
@@ -143,7 +155,7 @@ class S3CSE(object):
         if self._s3_client is None:
             self.setup()
 
-        s3_response = self._s3_client.get_object(Bucket=Bucket, Key=Key)
+        s3_response = self._retry_policy.call(self._s3_client, 'get_object', Bucket=Bucket, Key=Key)
         metadata = s3_response['Metadata']
         whole_file_length = int(s3_response['ResponseMetadata']['HTTPHeaders']['content-length'])
         if 'x-amz-key' not in metadata and 'x-amz-key-v2' not in metadata:
@@ -267,7 +279,9 @@ class S3CSE(object):
             Metadata['x-amz-key-v2'] = key_metadata
             Body = result
 
-        response = self._s3_client.put_object(
+        response = self._retry_policy.call(
+            self._s3_client,
+            'put_object',
             Bucket=Bucket,
             Key=Key,
             Body=Body,
@@ -0,0 +1,277 @@
+"""Concurrent scan of the CSE encryption status of every object under a bucket prefix."""
+
+import gzip
+import io
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import unquote_plus, urlparse
+
+import boto3
+import pandas as pd
+from botocore.exceptions import BotoCoreError, ClientError
+
+import cse_throttling
+import utils
+
+INVENTORY_COLUMNS = ['key', 'size', 'last_modified', 'encrypted', 'cek_alg', 'wrap_alg', 'kms_cmk_id',
+                     'unencrypted_length', 'error']
+CATEGORY_COLUMNS = ['cek_alg', 'wrap_alg', 'kms_cmk_id', 'error']
+
+DEFAULT_MAX_WORKERS = 32
+LIST_PAGE_SIZE = 1000
+# Pages (or inventory files) whose HEADs may be queued at once, the next one is listed while the current runs
+PAGES_IN_FLIGHT = 2
+
+
+def parse_s3_uri(uri: str) -> Tuple[str, str]:
+    parsed = urlparse(uri)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise ValueError(f"Not an s3:// uri: {uri}")
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def encryption_status(metadata):
+    """
+    Extract the CSE fields of an object's user metadata
+    :param metadata: 'Metadata' of a head_object/get_object response
+    :return: dict with encrypted, cek_alg, wrap_alg, kms_cmk_id and unencrypted_length
+    """
+    encrypted = utils.is_encrypted(metadata)
+    kms_cmk_id = None
+    if 'x-amz-matdesc' in metadata:
+        try:
+            kms_cmk_id = json.loads(metadata['x-amz-matdesc']).get('kms_cmk_id')
+        except (ValueError, AttributeError):
+            kms_cmk_id = None
+    unencrypted_length = metadata.get('x-amz-unencrypted-content-length')
+    return {
+        'encrypted': encrypted,
+        'cek_alg': metadata.get('x-amz-cek-alg', 'AES/CBC/PKCS5Padding' if encrypted else None),
+        'wrap_alg': metadata.get('x-amz-wrap-alg'),
+        'kms_cmk_id': kms_cmk_id,
+        'unencrypted_length': int(unencrypted_length) if unencrypted_length else None,
+    }
+
+
+class InventoryScanner:
+    """
+    Lists a bucket prefix (or reads an S3 Inventory manifest) and HEADs every object concurrently
+    :param bucket: S3 Bucket to audit
+    :param prefix: Only objects whose key starts with prefix are scanned
+    :param max_workers: Number of concurrent head_object calls
+    :param checkpoint: Optional local json file recording progress, an existing one resumes the scan.
+        Scanned rows are kept as parquet files in the <checkpoint>.parts directory
+    :param manifest: Optional s3:// uri of an S3 Inventory manifest.json, used instead of listing
+    :param retry_policy: Rate limiting and retry policy, defaults to the process-wide one
+    :param s3_client: Optional boto3 S3 client
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', max_workers: int = DEFAULT_MAX_WORKERS,
+                 checkpoint: Optional[str] = None, manifest: Optional[str] = None,
+                 retry_policy: Optional[cse_throttling.RetryPolicy] = None, s3_client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_workers = max(1, max_workers)
+        self.checkpoint = checkpoint
+        self.manifest = manifest
+        self._retry_policy = retry_policy if retry_policy else cse_throttling.default_retry_policy
+        if s3_client is None:
+            s3_client = boto3.client("s3", config=cse_throttling.client_config(max_pool_connections=self.max_workers))
+        self._s3_client = s3_client
+        self._state = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        state = {'bucket': self.bucket, 'prefix': self.prefix, 'manifest': self.manifest,
+                 'start_after': None, 'files_done': 0, 'objects': 0, 'parts': 0, 'complete': False}
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                saved = json.load(f)
+            if (saved.get('bucket'), saved.get('prefix'), saved.get('manifest')) != \
+                    (self.bucket, self.prefix, self.manifest):
+                raise ValueError(f"Checkpoint {self.checkpoint} belongs to a different scan")
+            state.update(saved)
+            logging.info(f"Resuming inventory of s3://{self.bucket}/{self.prefix} "
+                         f"after {state['objects']} objects")
+        return state
+
+    def _part_file(self, part):
+        return os.path.join(f"{self.checkpoint}.parts", f"{part:05d}.parquet")
+
+    def _save_part(self, df):
+        if not self.checkpoint:
+            return
+        os.makedirs(f"{self.checkpoint}.parts", exist_ok=True)
+        df.to_parquet(self._part_file(self._state['parts']), engine='pyarrow', index=False)
+        self._state['parts'] += 1
+
+    def saved_batches(self) -> List[pd.DataFrame]:
+        """
+        Dataframes scanned before the checkpoint was last saved
+        """
+        if not self.checkpoint:
+            return []
+        return [pd.read_parquet(self._part_file(part)) for part in range(self._state['parts'])]
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        tmp_file = f"{self.checkpoint}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self._state, f)
+        os.replace(tmp_file, self.checkpoint)
+
+    def _head(self, key):
+        row = {'key': key, 'size': None, 'last_modified': None, 'encrypted': None, 'cek_alg': None,
+               'wrap_alg': None, 'kms_cmk_id': None, 'unencrypted_length': None, 'error': None}
+        try:
+            response = self._retry_policy.call(self._s3_client, 'head_object', Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            row['error'] = cse_throttling.error_code(e) or str(e)
+            return row
+        except BotoCoreError as e:
+            # connection errors and timeouts left after the retry policy gave up
+            row['error'] = type(e).__name__
+            return row
+        row['size'] = response.get('ContentLength')
+        row['last_modified'] = response.get('LastModified')
+        row.update(encryption_status(response.get('Metadata', {})))
+        return row
+
+    def _listed_keys(self) -> Iterator[Tuple[List[str], dict]]:
+        kwargs = {'Bucket': self.bucket, 'Prefix': self.prefix, 'MaxKeys': LIST_PAGE_SIZE}
+        if self._state['start_after']:
+            kwargs['StartAfter'] = self._state['start_after']
+        while True:
+            response = self._retry_policy.call(self._s3_client, 'list_objects_v2', **kwargs)
+            keys = [item['Key'] for item in response.get('Contents', [])]
+            if keys:
+                yield keys, {'start_after': keys[-1]}
+            if not response.get('IsTruncated'):
+                return
+            kwargs.pop('StartAfter', None)
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def _read_manifest(self):
+        manifest_bucket, manifest_key = parse_s3_uri(self.manifest)
+        response = self._retry_policy.call(self._s3_client, 'get_object', Bucket=manifest_bucket, Key=manifest_key)
+        manifest = json.loads(response['Body'].read())
+        # destinationBucket is an arn, e.g. arn:aws:s3:::inventory-bucket
+        destination_bucket = manifest['destinationBucket'].split(':::')[-1]
+        return manifest, destination_bucket
+
+    def _inventory_file_df(self, manifest, destination_bucket, file_key):
+        response = self._retry_policy.call(self._s3_client, 'get_object', Bucket=destination_bucket, Key=file_key)
+        data = response['Body'].read()
+        file_format = manifest.get('fileFormat', 'CSV').upper()
+        if file_format == 'CSV':
+            names = [name.strip().lower() for name in manifest['fileSchema'].split(',')]
+            df = pd.read_csv(io.BytesIO(gzip.decompress(data)), header=None, names=names, dtype=str,
+                             keep_default_na=False)
+            # keys in csv inventory files are url encoded
+            df['key'] = df['key'].map(unquote_plus)
+        elif file_format == 'PARQUET':
+            df = pd.read_parquet(io.BytesIO(data))
+        elif file_format == 'ORC':
+            from pyarrow import orc
+            df = orc.ORCFile(io.BytesIO(data)).read().to_pandas()
+        else:
+            raise ValueError(f"Unsupported inventory file format {file_format}")
+        df.columns = [str(column).lower().replace('_', '') for column in df.columns]
+        return df
+
+    def _manifest_keys(self) -> Iterator[Tuple[List[str], dict]]:
+        manifest, destination_bucket = self._read_manifest()
+        files = manifest['files']
+        for file_index in range(self._state['files_done'], len(files)):
+            df = self._inventory_file_df(manifest, destination_bucket, files[file_index]['key'])
+            if 'bucket' in df.columns:
+                df = df[df['bucket'] == self.bucket]
+            # versioned inventories list every version, only the current ones are audited
+            if 'islatest' in df.columns:
+                df = df[df['islatest'].astype(str).str.lower() == 'true']
+            if 'isdeletemarker' in df.columns:
+                df = df[df['isdeletemarker'].astype(str).str.lower() != 'true']
+            keys = [key for key in df['key'] if key.startswith(self.prefix)]
+            yield keys, {'files_done': file_index + 1}
+
+    def _complete_page(self, futures, progress):
+        df = compact_df([future.result() for future in futures])
+        self._save_part(df)
+        self._state.update(progress)
+        self._state['objects'] += len(df)
+        self._save_checkpoint()
+        logging.info(f"Inventory of s3://{self.bucket}/{self.prefix}: {self._state['objects']} objects")
+        return df
+
+    def batches(self) -> Iterator[pd.DataFrame]:
+        """
+        Scan incrementally, checkpointing after each listing page or inventory file.
+        HEADs are queued per object so that the next page is listed while the current one is scanned,
+        pages are still completed and checkpointed in order.
+        :return: Iterator of dataframes, one per page/inventory file not scanned before
+        """
+        if self._state['complete']:
+            return
+        key_batches = self._manifest_keys() if self.manifest else self._listed_keys()
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for keys, progress in key_batches:
+                pending.append(([executor.submit(self._head, key) for key in keys], progress))
+                while len(pending) >= PAGES_IN_FLIGHT:
+                    yield self._complete_page(*pending.popleft())
+            while pending:
+                yield self._complete_page(*pending.popleft())
+        finally:
+            for futures, _ in pending:
+                for future in futures:
+                    future.cancel()
+            executor.shutdown(wait=True)
+        self._state['complete'] = True
+        self._save_checkpoint()
+
+
+def compact_df(rows):
+    df = pd.DataFrame(rows, columns=INVENTORY_COLUMNS)
+    df['last_modified'] = pd.to_datetime(df['last_modified'], utc=True)
+    df['size'] = df['size'].astype('Int64')
+    df['unencrypted_length'] = df['unencrypted_length'].astype('Int64')
+    df['encrypted'] = df['encrypted'].astype('boolean')
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    return df
+
+
+def iter_inventory(bucket, prefix='', max_workers=DEFAULT_MAX_WORKERS, checkpoint=None, manifest=None,
+                   retry_policy=None, s3_client=None):
+    """
+    Encryption status of the objects under a prefix, one dataframe per page.
+    When resuming from a checkpoint only the objects not scanned before are yielded
+    """
+    scanner = InventoryScanner(bucket, prefix, max_workers=max_workers, checkpoint=checkpoint,
+                               manifest=manifest, retry_policy=retry_policy, s3_client=s3_client)
+    return scanner.batches()
+
+
+def inventory(bucket, prefix='', max_workers=DEFAULT_MAX_WORKERS, checkpoint=None, manifest=None,
+              as_arrow=False, retry_policy=None, s3_client=None):
+    """
+    Encryption status of every object under a prefix.
+    When resuming from a checkpoint the rows saved by earlier runs are included
+    :param as_arrow: Return a pyarrow Table instead of a dataframe
+    """
+    scanner = InventoryScanner(bucket, prefix, max_workers=max_workers, checkpoint=checkpoint,
+                               manifest=manifest, retry_policy=retry_policy, s3_client=s3_client)
+    batches = scanner.saved_batches() + list(scanner.batches())
+    df = pd.concat(batches, ignore_index=True) if batches else compact_df([])
+    # concat of batches with different categories falls back to object
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    if as_arrow:
+        import pyarrow as pa
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return df
@@ -4,6 +4,7 @@ import pandas as pd
 import io
 from cse_performance_counters import CsePerformanceCounters
 import utils
+import cse_inventory
 from s3_cse_client import S3CseClient
 
 cse_perf_counters = CsePerformanceCounters()
@@ -90,6 +91,15 @@ def file_metadata(bucket,
     return metadata
 
 
+def inventory_df(bucket,
+                 prefix='',
+                 max_workers=cse_inventory.DEFAULT_MAX_WORKERS,
+                 checkpoint=None,
+                 manifest=None):
+    return cse_inventory.inventory(bucket, prefix, max_workers=max_workers, checkpoint=checkpoint,
+                                   manifest=manifest)
+
+
 def read_parquet_df(bucket,
                     filename,
                     cmk_id=None,
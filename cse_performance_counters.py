@@ -12,6 +12,8 @@ class CsePerformanceCounter:
     operation: str
     cse: str
     duration: float
+    retries: int = 0
+    throttles: int = 0
 
 
 class CsePerformanceCounters:
@@ -22,7 +24,7 @@ class CsePerformanceCounters:
     def __init__(self):
         self._counters = []
 
-    def add_counter(self, bucket, object_key, operation, cse, duration):
+    def add_counter(self, bucket, object_key, operation, cse, duration, retries=0, throttles=0):
         file_extension = file_extension = os.path.splitext(object_key)
         file_type = file_extension[1].replace('.', '', 1).lower() if file_extension[1] else ''
         cse_string = "CSE" if cse else "NO CSE"
@@ -30,5 +32,7 @@ class CsePerformanceCounters:
                                         object_key=object_key,
                                         operation=operation, cse=cse_string,
                                         file_type=file_type,
-                                        duration=duration)
+                                        duration=duration,
+                                        retries=retries,
+                                        throttles=throttles)
         self._counters.append(asdict(counter))
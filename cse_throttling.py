@@ -0,0 +1,277 @@
+"""Process-wide rate limiting and adaptive retries for KMS and S3 calls."""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, ConnectTimeoutError, ReadTimeoutError
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'InternalFailure',
+    'KMSInternalException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+}
+
+# Network failures botocore's legacy retry mode used to retry, retried here without shrinking the rate.
+# ConnectionError covers EndpointConnectionError, ConnectionClosedError and ConnectTimeoutError
+TRANSIENT_EXCEPTIONS = (ConnectionError, ConnectTimeoutError, ReadTimeoutError)
+
+# Requests per second a bucket starts with, per service.
+# KMS shares a per-account/region quota for cryptographic operations,
+# S3 allows at least 3,500 PUT and 5,500 GET requests per second per prefix
+DEFAULT_RATES = {
+    'kms': 1000.0,
+    's3': 3500.0,
+}
+FALLBACK_RATE = 100.0
+
+
+def client_config(**kwargs):
+    """
+    botocore Config for clients created by this library.
+    botocore's own retries are switched off so that every throttle reaches the limiter.
+    """
+    return Config(retries={'total_max_attempts': 1}, **kwargs)
+
+
+@dataclass
+class RetryStats:
+    retries: int = 0
+    throttles: int = 0
+
+    def add(self, other):
+        self.retries += other.retries
+        self.throttles += other.throttles
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket.
+    The rate halves when the service throttles us and creeps back towards max_rate on success.
+    Concurrent callers throttled by the same burst only halve it once per decrease_interval.
+    :param rate: Requests per second
+    :param capacity: Maximum burst size, defaults to one second's worth of tokens
+    :param min_rate: Floor the rate is never reduced below
+    :param decrease_factor: Multiplier applied to the rate on throttling
+    :param increase_step: Requests per second added back after each successful call
+    :param decrease_interval: Seconds after a decrease during which further throttles are ignored
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: float = 1.0,
+                 decrease_factor: float = 0.5, increase_step: Optional[float] = None,
+                 decrease_interval: float = 1.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, float(rate))
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step if increase_step else max(self.max_rate / 100, 0.1)
+        self.decrease_interval = decrease_interval
+        self._last_decrease = None
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> float:
+        """
+        Block until a token is available
+        :return: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+                return
+            self._last_decrease = now
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+
+class RateLimiterRegistry:
+    """
+    One token bucket per (service, region, operation), shared by every client in the process
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        self._rates = dict(DEFAULT_RATES)
+        if rates:
+            self._rates.update(rates)
+        self._buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, service: str, rate: float, operation: Optional[str] = None):
+        """
+        Set the rate used for new buckets of a service, or of a single operation of it.
+        Existing buckets for the same service/operation are dropped so the new rate applies straight away.
+        """
+        with self._lock:
+            rate_key = service if operation is None else f"{service}.{operation}"
+            self._rates[rate_key] = rate
+            for key in list(self._buckets):
+                if key[0] == service and (operation is None or key[2] == operation):
+                    del self._buckets[key]
+
+    def get(self, service: str, region: Optional[str], operation: str) -> TokenBucket:
+        key = (service, region or '', operation)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate = self._rates.get(f"{service}.{operation}", self._rates.get(service, FALLBACK_RATE))
+                bucket = TokenBucket(rate)
+                self._buckets[key] = bucket
+            return bucket
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+rate_limiters = RateLimiterRegistry()
+
+_local = threading.local()
+
+
+@contextmanager
+def track_retries():
+    """
+    Collect retries and throttles of every call made by the current thread inside the block
+    """
+    stats = RetryStats()
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+        if previous is not None:
+            previous.add(stats)
+
+
+def error_code(error: ClientError) -> str:
+    return error.response.get('Error', {}).get('Code', '')
+
+
+def is_throttling_error(error: ClientError, service: Optional[str] = None) -> bool:
+    """
+    S3 throttles with 503 SlowDown, HEAD responses have no body so botocore only reports the code '503'
+    """
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    if service == 's3' and status == 503:
+        return True
+    return error_code(error) in THROTTLING_ERROR_CODES or status == 429
+
+
+def is_transient_error(error: ClientError) -> bool:
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return error_code(error) in TRANSIENT_ERROR_CODES or (status is not None and status >= 500)
+
+
+class RetryPolicy:
+    """
+    Rate limited calls with exponential backoff and full jitter.
+    Throttling errors also shrink the rate of the (service, region, operation) bucket,
+    transient 5xx errors and connection errors/timeouts are retried at the same rate.
+    :param max_attempts: Total attempts including the first one
+    :param base_delay: Backoff for the first retry in seconds
+    :param max_delay: Upper bound for a single backoff in seconds
+    :param limiters: Registry of token buckets, defaults to the process-wide one
+    """
+
+    def __init__(self, max_attempts: int = 8, base_delay: float = 0.05, max_delay: float = 20.0,
+                 limiters: Optional[RateLimiterRegistry] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiters = limiters if limiters is not None else rate_limiters
+        self.stats = RetryStats()
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _record(self, retries: int = 0, throttles: int = 0):
+        delta = RetryStats(retries=retries, throttles=throttles)
+        with self._lock:
+            self.stats.add(delta)
+        stats = getattr(_local, 'stats', None)
+        if stats is not None:
+            stats.add(delta)
+
+    def call(self, client, operation: str, **kwargs):
+        """
+        Call a boto3 client operation through the limiter
+        :param client: boto3 client
+        :param operation: Client method name, e.g. 'generate_data_key'
+        :return: The client's response
+        """
+        service = client.meta.service_model.service_name
+        bucket = self.limiters.get(service, client.meta.region_name, operation)
+        method = getattr(client, operation)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = method(**kwargs)
+            except ClientError as e:
+                throttled = is_throttling_error(e, service)
+                if not throttled and not is_transient_error(e):
+                    raise
+                if throttled:
+                    bucket.on_throttle()
+                    self._record(throttles=1)
+                error = e
+            except TRANSIENT_EXCEPTIONS as e:
+                error = e
+            else:
+                bucket.on_success()
+                return response
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise error
+            self._record(retries=1)
+            time.sleep(self.backoff(attempt - 1))
+
+
+default_retry_policy = RetryPolicy()
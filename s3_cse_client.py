@@ -3,6 +3,7 @@ import time
 
 import boto3
 
+import cse_throttling
 import utils
 from cse import KMSCryptoContext, S3CSE
 from cse_performance_counters import CsePerformanceCounters
@@ -15,12 +16,14 @@ logging.basicConfig(level=logging.INFO,
 
 class S3CseClient:
 
-    def __init__(self, key_id, perf_counters=None):
+    def __init__(self, key_id, perf_counters=None, retry_policy=None):
         operations_log = []
-        self._s3_client = boto3.client("s3")
+        self._s3_client = boto3.client("s3", config=cse_throttling.client_config())
         self.key_id = key_id
-        self._ctx = KMSCryptoContext(keyid=key_id, kms_client_args={'region_name': 'eu-west-2'})
-        self._s3cse = S3CSE(crypto_context=self._ctx, s3_client=self._s3_client)
+        self._retry_policy = retry_policy if retry_policy else cse_throttling.default_retry_policy
+        self._ctx = KMSCryptoContext(keyid=key_id, kms_client_args={'region_name': 'eu-west-2'},
+                                     retry_policy=self._retry_policy)
+        self._s3cse = S3CSE(crypto_context=self._ctx, s3_client=self._s3_client, retry_policy=self._retry_policy)
         self.last_operation_duration = 0
         self.perf_counters = perf_counters
 
@@ -33,14 +36,16 @@ class S3CseClient:
 
         logging.info(f"Writing object and its metadata to S3 ({encryption_msg})")
         start = time.process_time()
-        response = self._s3cse.put_object(data, bucket, filename)
+        with cse_throttling.track_retries() as retry_stats:
+            response = self._s3cse.put_object(data, bucket, filename)
         finish = time.process_time()
         self.last_operation_duration = finish - start
         self.add_perf_counter(bucket,
                               filename,
                               CsePerformanceCounters.write,
                               cse_used,
-                              self.last_operation_duration)
+                              self.last_operation_duration,
+                              retry_stats)
         logging.info(f"{filename} was writen in {utils.format_time_elapsed(self.last_operation_duration)}")
         return response
 
@@ -48,14 +53,16 @@ class S3CseClient:
         start = time.process_time()
         logging.info("Downloading object and its metadata from S3")
         start = time.process_time()
-        response = self._s3cse.get_object(bucket, filename)
+        with cse_throttling.track_retries() as retry_stats:
+            response = self._s3cse.get_object(bucket, filename)
         finish = time.process_time()
         self.last_operation_duration = finish - start
         self.add_perf_counter(bucket,
                               filename,
                               CsePerformanceCounters.read,
                               self.is_encrypted(response['Metadata']),
-                              self.last_operation_duration)
+                              self.last_operation_duration,
+                              retry_stats)
         result = response['Body'].read()
         logging.info(f"{filename} was read in {utils.format_time_elapsed(self.last_operation_duration)}")
         return result
@@ -66,10 +73,12 @@ class S3CseClient:
     def get_metadata(self, bucket, filename, extended=False):
         logging.info("Retrieving object metadata from S3 without downloading the object itself")
         start = time.process_time()
-        response = self._s3_client.head_object(Bucket=bucket, Key=filename)
+        with cse_throttling.track_retries() as retry_stats:
+            response = self._retry_policy.call(self._s3_client, 'head_object', Bucket=bucket, Key=filename)
         finish = time.process_time()
         self.last_operation_duration = finish - start
-        self.add_perf_counter(bucket, filename, CsePerformanceCounters.head, None, self.last_operation_duration)
+        self.add_perf_counter(bucket, filename, CsePerformanceCounters.head, None, self.last_operation_duration,
+                              retry_stats)
         logging.info(f"Metadata for {filename} was read in {utils.format_time_elapsed(self.last_operation_duration)}")
         if extended:
             result = response
@@ -77,9 +86,12 @@ class S3CseClient:
             result = response['Metadata']
         return result
 
-    def add_perf_counter(self, bucket, filename, operation, cse, duration):
+    def add_perf_counter(self, bucket, filename, operation, cse, duration, retry_stats=None):
         if self.perf_counters:
-            self.perf_counters.add_counter(bucket, filename, operation, cse, duration)
+            retries = retry_stats.retries if retry_stats else 0
+            throttles = retry_stats.throttles if retry_stats else 0
+            self.perf_counters.add_counter(bucket, filename, operation, cse, duration,
+                                           retries=retries, throttles=throttles)
 
 
 if __name__ == '__main__':
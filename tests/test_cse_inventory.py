@@ -0,0 +1,255 @@
+import gzip
+import io
+import json
+import threading
+
+import boto3
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+import cse_inventory
+import cse_throttling
+
+BUCKET = 'test-bucket'
+PREFIX = 'p/'
+CMK = 'arn:aws:kms:eu-west-2:111122223333:key/1234abcd'
+ENCRYPTED_METADATA = {
+    'x-amz-key-v2': 'a2V5',
+    'x-amz-cek-alg': 'AES/GCM/NoPadding',
+    'x-amz-wrap-alg': 'kms',
+    'x-amz-matdesc': json.dumps({'kms_cmk_id': CMK}),
+    'x-amz-unencrypted-content-length': '5',
+}
+
+
+@pytest.fixture(autouse=True)
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-2')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setattr(cse_inventory, 'LIST_PAGE_SIZE', 2)
+
+
+@pytest.fixture
+def s3_client():
+    return boto3.client('s3', config=cse_throttling.client_config())
+
+
+@pytest.fixture
+def policy():
+    return cse_throttling.RetryPolicy(max_attempts=2, base_delay=0, limiters=cse_throttling.RateLimiterRegistry())
+
+
+def fake_head(s3_client, monkeypatch, heads):
+    """Replace head_object with a thread safe stand-in, Stubber responses are consumed in call order"""
+
+    def head_object(Bucket, Key):
+        assert Bucket == BUCKET
+        result = heads[Key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(s3_client, 'head_object', head_object)
+
+
+def head_response(metadata=None):
+    return {'ContentLength': 3, 'Metadata': metadata if metadata else {}}
+
+
+def add_list_page(stubber, keys, next_token=None, **params):
+    response = {'Contents': [{'Key': key} for key in keys], 'IsTruncated': next_token is not None}
+    if next_token:
+        response['NextContinuationToken'] = next_token
+    expected = {'Bucket': BUCKET, 'Prefix': PREFIX, 'MaxKeys': 2}
+    expected.update(params)
+    stubber.add_response('list_objects_v2', response, expected)
+
+
+def add_get_object(stubber, bucket, key, data):
+    stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(data), len(data))},
+                         {'Bucket': bucket, 'Key': key})
+
+
+def test_encryption_status_v2():
+    assert cse_inventory.encryption_status(ENCRYPTED_METADATA) == {
+        'encrypted': True,
+        'cek_alg': 'AES/GCM/NoPadding',
+        'wrap_alg': 'kms',
+        'kms_cmk_id': CMK,
+        'unencrypted_length': 5,
+    }
+
+
+def test_encryption_status_v1_defaults_to_cbc():
+    status = cse_inventory.encryption_status({'x-amz-key': 'a2V5', 'x-amz-matdesc': '{}'})
+    assert status['encrypted'] is True
+    assert status['cek_alg'] == 'AES/CBC/PKCS5Padding'
+    assert status['kms_cmk_id'] is None
+
+
+def test_encryption_status_ignores_invalid_matdesc():
+    status = cse_inventory.encryption_status({'x-amz-key-v2': 'a2V5', 'x-amz-matdesc': 'not json'})
+    assert status['kms_cmk_id'] is None
+
+
+def test_encryption_status_unencrypted():
+    assert cse_inventory.encryption_status({}) == {
+        'encrypted': False, 'cek_alg': None, 'wrap_alg': None, 'kms_cmk_id': None, 'unencrypted_length': None,
+    }
+
+
+def test_parse_s3_uri():
+    assert cse_inventory.parse_s3_uri('s3://bucket/a/manifest.json') == ('bucket', 'a/manifest.json')
+    with pytest.raises(ValueError):
+        cse_inventory.parse_s3_uri('https://bucket/a/manifest.json')
+
+
+def test_inventory_pages_listing(s3_client, policy, monkeypatch):
+    fake_head(s3_client, monkeypatch, {
+        'p/0': head_response(ENCRYPTED_METADATA),
+        'p/1': head_response(),
+        'p/2': ClientError({'Error': {'Code': '403'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'HeadObject'),
+    })
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/0', 'p/1'], next_token='t1')
+        add_list_page(stubber, ['p/2'], ContinuationToken='t1')
+        df = cse_inventory.inventory(BUCKET, PREFIX, max_workers=4, retry_policy=policy, s3_client=s3_client)
+        stubber.assert_no_pending_responses()
+    assert list(df['key']) == ['p/0', 'p/1', 'p/2']
+    assert list(df['encrypted'].astype(object)) == [True, False, pd.NA]
+    assert df.loc[0, 'kms_cmk_id'] == CMK
+    assert df.loc[0, 'unencrypted_length'] == 5
+    assert df.loc[2, 'error'] == '403'
+    assert df['cek_alg'].dtype == 'category'
+
+
+def test_throttled_heads_slow_down_and_are_retried(s3_client, policy, monkeypatch):
+    throttled = {'p/0', 'p/1'}
+    lock = threading.Lock()
+
+    def head_object(Bucket, Key):
+        with lock:
+            if Key in throttled:
+                throttled.discard(Key)
+                # the shape botocore gives a HEAD 503 SlowDown, which has no body
+                raise ClientError({'Error': {'Code': '503', 'Message': 'Service Unavailable'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 503}}, 'HeadObject')
+        return head_response(ENCRYPTED_METADATA)
+
+    monkeypatch.setattr(s3_client, 'head_object', head_object)
+    bucket = policy.limiters.get('s3', 'eu-west-2', 'head_object')
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/0', 'p/1'], next_token='t1')
+        add_list_page(stubber, ['p/2'], ContinuationToken='t1')
+        df = cse_inventory.inventory(BUCKET, PREFIX, max_workers=4, retry_policy=policy, s3_client=s3_client)
+    assert bucket.rate < bucket.max_rate
+    assert policy.stats.throttles == 2
+    assert list(df['key']) == ['p/0', 'p/1', 'p/2']
+    assert df['error'].isna().all()
+    assert df['encrypted'].all()
+    assert list(df['kms_cmk_id']) == [CMK] * 3
+
+
+def test_head_connection_errors_are_recorded(s3_client, policy, monkeypatch):
+    fake_head(s3_client, monkeypatch, {'p/0': ReadTimeoutError(endpoint_url='https://s3.amazonaws.com')})
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/0'])
+        df = cse_inventory.inventory(BUCKET, PREFIX, retry_policy=policy, s3_client=s3_client)
+    assert df.loc[0, 'error'] == 'ReadTimeoutError'
+
+
+def test_next_page_is_listed_while_heads_run(s3_client, policy, monkeypatch):
+    second_page_listed = threading.Event()
+    list_calls = []
+
+    def on_list(**kwargs):
+        list_calls.append(kwargs)
+        if len(list_calls) == 2:
+            second_page_listed.set()
+
+    s3_client.meta.events.register('before-parameter-build.s3.ListObjectsV2', on_list)
+    heads = {f'p/{i}': head_response() for i in range(4)}
+    first_head_saw_second_page = []
+
+    def head_object(Bucket, Key):
+        if Key == 'p/0':
+            first_head_saw_second_page.append(second_page_listed.wait(timeout=5))
+        return heads[Key]
+
+    monkeypatch.setattr(s3_client, 'head_object', head_object)
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/0', 'p/1'], next_token='t1')
+        add_list_page(stubber, ['p/2', 'p/3'], ContinuationToken='t1')
+        df = cse_inventory.inventory(BUCKET, PREFIX, max_workers=2, retry_policy=policy, s3_client=s3_client)
+    assert first_head_saw_second_page == [True]
+    assert list(df['key']) == ['p/0', 'p/1', 'p/2', 'p/3']
+
+
+def test_resume_returns_every_object(s3_client, policy, monkeypatch, tmp_path):
+    checkpoint = str(tmp_path / 'scan.json')
+    heads = {'p/0': head_response(ENCRYPTED_METADATA), 'p/1': head_response(),
+             'p/2': RuntimeError('interrupted'), 'p/3': head_response()}
+    fake_head(s3_client, monkeypatch, heads)
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/0', 'p/1'], next_token='t1')
+        add_list_page(stubber, ['p/2', 'p/3'], ContinuationToken='t1')
+        with pytest.raises(RuntimeError):
+            cse_inventory.inventory(BUCKET, PREFIX, checkpoint=checkpoint, retry_policy=policy, s3_client=s3_client)
+
+    with open(checkpoint) as f:
+        state = json.load(f)
+    assert state['start_after'] == 'p/1'
+    assert state['objects'] == 2
+    assert state['parts'] == 1
+    assert not state['complete']
+
+    heads['p/2'] = head_response()
+    with Stubber(s3_client) as stubber:
+        add_list_page(stubber, ['p/2', 'p/3'], StartAfter='p/1')
+        df = cse_inventory.inventory(BUCKET, PREFIX, checkpoint=checkpoint, retry_policy=policy,
+                                     s3_client=s3_client)
+        stubber.assert_no_pending_responses()
+    assert list(df['key']) == ['p/0', 'p/1', 'p/2', 'p/3']
+    assert df.loc[0, 'kms_cmk_id'] == CMK
+
+    # a finished scan lists nothing and still returns every object
+    with Stubber(s3_client):
+        table = cse_inventory.inventory(BUCKET, PREFIX, checkpoint=checkpoint, as_arrow=True,
+                                        retry_policy=policy, s3_client=s3_client)
+    assert table.column('key').to_pylist() == ['p/0', 'p/1', 'p/2', 'p/3']
+
+
+def test_checkpoint_of_another_scan_is_rejected(s3_client, policy, tmp_path):
+    checkpoint = tmp_path / 'scan.json'
+    checkpoint.write_text(json.dumps({'bucket': 'other', 'prefix': PREFIX, 'manifest': None}))
+    with pytest.raises(ValueError):
+        cse_inventory.InventoryScanner(BUCKET, PREFIX, checkpoint=str(checkpoint), s3_client=s3_client)
+
+
+def test_inventory_from_csv_manifest(s3_client, policy, monkeypatch):
+    manifest = {
+        'destinationBucket': 'arn:aws:s3:::inventory-bucket',
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size',
+        'files': [{'key': 'inv/data/1.csv.gz'}],
+    }
+    rows = [
+        '"test-bucket","p/a%20b","v1","true","false","3"',
+        '"test-bucket","p/old","v0","false","false","3"',
+        '"test-bucket","p/deleted","v2","true","true",""',
+        '"test-bucket","q/other","v1","true","false","3"',
+        '"other-bucket","p/x","v1","true","false","3"',
+    ]
+    fake_head(s3_client, monkeypatch, {'p/a b': head_response(ENCRYPTED_METADATA)})
+    with Stubber(s3_client) as stubber:
+        add_get_object(stubber, 'inventory-bucket', 'inv/manifest.json', json.dumps(manifest).encode())
+        add_get_object(stubber, 'inventory-bucket', 'inv/data/1.csv.gz', gzip.compress('\n'.join(rows).encode()))
+        df = cse_inventory.inventory(BUCKET, PREFIX, manifest='s3://inventory-bucket/inv/manifest.json',
+                                     retry_policy=policy, s3_client=s3_client)
+        stubber.assert_no_pending_responses()
+    assert list(df['key']) == ['p/a b']
+    assert df.loc[0, 'kms_cmk_id'] == CMK
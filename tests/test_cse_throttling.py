@@ -0,0 +1,191 @@
+import threading
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+
+import cse_throttling
+from cse_performance_counters import CsePerformanceCounters
+from s3_cse_client import S3CseClient
+
+BUCKET = 'test-bucket'
+KEY = 'data/test.parquet'
+HEAD_PARAMS = {'Bucket': BUCKET, 'Key': KEY}
+HEAD_RESPONSE = {'ContentLength': 3, 'Metadata': {}}
+
+
+@pytest.fixture(autouse=True)
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-west-2')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+
+
+@pytest.fixture
+def s3_client():
+    return boto3.client('s3', config=cse_throttling.client_config())
+
+
+@pytest.fixture
+def policy():
+    limiters = cse_throttling.RateLimiterRegistry({'s3': 100.0})
+    return cse_throttling.RetryPolicy(max_attempts=4, base_delay=0, limiters=limiters)
+
+
+def add_throttle(stubber, code='SlowDown', status=503):
+    stubber.add_client_error('head_object', service_error_code=code, http_status_code=status,
+                             expected_params=HEAD_PARAMS)
+
+
+def head_503():
+    # HEAD responses have no body, botocore reports the status code as the error code
+    return ClientError({'Error': {'Code': '503', 'Message': 'Service Unavailable'},
+                        'ResponseMetadata': {'HTTPStatusCode': 503}}, 'HeadObject')
+
+
+def test_s3_503_without_code_is_throttling():
+    assert cse_throttling.is_throttling_error(head_503(), 's3')
+    assert not cse_throttling.is_throttling_error(head_503(), 'kms')
+    assert cse_throttling.is_transient_error(head_503())
+
+
+def test_client_config_disables_botocore_retries():
+    assert cse_throttling.client_config().retries == {'total_max_attempts': 1}
+
+
+def test_throttles_are_retried_and_counted(s3_client, policy):
+    with Stubber(s3_client) as stubber:
+        add_throttle(stubber)
+        add_throttle(stubber, code='ThrottlingException', status=400)
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        with cse_throttling.track_retries() as stats:
+            response = policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+        stubber.assert_no_pending_responses()
+    assert response['ContentLength'] == 3
+    assert stats == cse_throttling.RetryStats(retries=2, throttles=2)
+    assert policy.stats == cse_throttling.RetryStats(retries=2, throttles=2)
+
+
+def test_head_503_is_counted_as_throttle_and_halves_rate(s3_client, policy):
+    bucket = policy.limiters.get('s3', 'eu-west-2', 'head_object')
+    with Stubber(s3_client) as stubber:
+        stubber.add_client_error('head_object', service_error_code='503', service_message='Service Unavailable',
+                                 http_status_code=503, expected_params=HEAD_PARAMS)
+        with cse_throttling.track_retries() as stats:
+            with pytest.raises(ClientError) as error:
+                cse_throttling.RetryPolicy(max_attempts=1, limiters=policy.limiters).call(
+                    s3_client, 'head_object', **HEAD_PARAMS)
+    assert cse_throttling.error_code(error.value) == '503'
+    assert stats.throttles == 1
+    assert bucket.rate == 50.0
+
+
+def test_throttle_halves_rate_and_success_recovers_it(s3_client, policy):
+    bucket = policy.limiters.get('s3', 'eu-west-2', 'head_object')
+    with Stubber(s3_client) as stubber:
+        add_throttle(stubber)
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        with pytest.raises(ClientError):
+            cse_throttling.RetryPolicy(max_attempts=1, limiters=policy.limiters).call(
+                s3_client, 'head_object', **HEAD_PARAMS)
+        assert bucket.rate == 50.0
+        policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+        assert bucket.rate == 51.0
+        policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+        assert bucket.rate == 52.0
+
+
+def test_concurrent_throttles_halve_rate_once():
+    bucket = cse_throttling.TokenBucket(100.0)
+    workers = 32
+    barrier = threading.Barrier(workers)
+
+    def throttled():
+        barrier.wait()
+        bucket.on_throttle()
+
+    threads = [threading.Thread(target=throttled) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert bucket.rate == 50.0
+
+
+def test_throttles_after_decrease_interval_halve_rate_again():
+    bucket = cse_throttling.TokenBucket(100.0, decrease_interval=0)
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 25.0
+
+
+def test_rate_never_exceeds_configured_rate(s3_client, policy):
+    bucket = policy.limiters.get('s3', 'eu-west-2', 'head_object')
+    with Stubber(s3_client) as stubber:
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+    assert bucket.rate == 100.0
+
+
+def test_reraises_after_max_attempts(s3_client, policy):
+    with Stubber(s3_client) as stubber:
+        for _ in range(policy.max_attempts):
+            add_throttle(stubber)
+        with cse_throttling.track_retries() as stats:
+            with pytest.raises(ClientError) as error:
+                policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+        stubber.assert_no_pending_responses()
+    assert cse_throttling.error_code(error.value) == 'SlowDown'
+    assert stats == cse_throttling.RetryStats(retries=3, throttles=4)
+
+
+def test_client_errors_are_not_retried(s3_client, policy):
+    with Stubber(s3_client) as stubber:
+        stubber.add_client_error('head_object', service_error_code='403', http_status_code=403,
+                                 expected_params=HEAD_PARAMS)
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        with cse_throttling.track_retries() as stats:
+            with pytest.raises(ClientError):
+                policy.call(s3_client, 'head_object', **HEAD_PARAMS)
+    assert stats == cse_throttling.RetryStats()
+    assert policy.limiters.get('s3', 'eu-west-2', 'head_object').rate == 100.0
+
+
+def test_connection_errors_are_retried_without_shrinking_rate(s3_client, policy, monkeypatch):
+    calls = []
+
+    def head_object(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise EndpointConnectionError(endpoint_url='https://s3.eu-west-2.amazonaws.com')
+        return HEAD_RESPONSE
+
+    monkeypatch.setattr(s3_client, 'head_object', head_object)
+    with cse_throttling.track_retries() as stats:
+        assert policy.call(s3_client, 'head_object', **HEAD_PARAMS) == HEAD_RESPONSE
+    assert len(calls) == 2
+    assert stats == cse_throttling.RetryStats(retries=1, throttles=0)
+    assert policy.limiters.get('s3', 'eu-west-2', 'head_object').rate == 100.0
+
+
+def test_perf_counters_record_retries_and_throttles(policy):
+    counters = CsePerformanceCounters()
+    client = S3CseClient(None, perf_counters=counters, retry_policy=policy)
+    with Stubber(client._s3_client) as stubber:
+        add_throttle(stubber)
+        stubber.add_response('head_object', HEAD_RESPONSE, HEAD_PARAMS)
+        client.get_metadata(BUCKET, KEY)
+    counter = counters._counters[-1]
+    assert counter['operation'] == CsePerformanceCounters.head
+    assert counter['retries'] == 1
+    assert counter['throttles'] == 1
+
+
+def test_add_perf_counter_defaults_to_no_retries():
+    counters = CsePerformanceCounters()
+    client = S3CseClient(None, perf_counters=counters)
+    client.add_perf_counter(BUCKET, KEY, CsePerformanceCounters.read, True, 0.1)
+    assert counters._counters[-1]['retries'] == 0
+    assert counters._counters[-1]['throttles'] == 0